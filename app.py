@@ -1,36 +1,77 @@
 import os
-import json
+import asyncio
 import base64
+import hmac
 import logging
+import logging.handlers
 import unicodedata
 import re
+import queue
+import atexit
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 from typing import Any, Dict, List, Optional
+from urllib.parse import quote
 
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import JSONResponse, PlainTextResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, Response
 
+import orjson
 import psycopg
+import requests
 from psycopg.rows import dict_row
+from psycopg_pool import ConnectionPool, PoolTimeout
+from urllib3.exceptions import NewConnectionError
 
+from google.auth.exceptions import GoogleAuthError
+from google.auth.transport.requests import AuthorizedSession, Request as GoogleAuthRequest
 from google.oauth2 import service_account
-from googleapiclient.discovery import build
 
 
 # ---------------------------
 # Logging
 # ---------------------------
-logging.basicConfig(level=logging.INFO)
+# A thread do request só enfileira o LogRecord; a escrita no stderr fica numa thread própria.
+_log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(-1)
+_log_stream_handler = logging.StreamHandler()
+_log_stream_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_stream_handler, respect_handler_level=True)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+_log_queue_handler = logging.handlers.QueueHandler(_log_queue)
+_log_queue_handler.setFormatter(logging.Formatter("%(message)s"))  # prefixo só no handler final
+
+# LOG_LEVEL=WARNING em produção corta até o log por mensagem; DEBUG inclui o payload bruto.
+LOG_LEVEL = (os.getenv("LOG_LEVEL", "INFO") or "INFO").strip().upper()
+# Nível inválido não pode derrubar o worker no import: cai pra INFO e avisa.
+_LOG_LEVEL_INVALID = not isinstance(logging.getLevelName(LOG_LEVEL), int)
+
+logging.basicConfig(level="INFO" if _LOG_LEVEL_INVALID else LOG_LEVEL, handlers=[_log_queue_handler])
 logger = logging.getLogger("contact-solution")
+if _LOG_LEVEL_INVALID:
+    logger.warning("LOG_LEVEL inválido (%r); usando INFO.", LOG_LEVEL)
+    LOG_LEVEL = "INFO"
 
 
 # ---------------------------
 # Env
 # ---------------------------
 VERIFY_TOKEN = os.getenv("VERIFY_TOKEN", "")
+_VERIFY_TOKEN_BYTES = VERIFY_TOKEN.encode("utf-8")
 
 # DB
 DATABASE_URL = os.getenv("DATABASE_URL", "")
+# Pool por processo: o webhook roda em até MESSAGE_CONCURRENCY threads, cada uma com 1 conexão por vez.
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+# Banco fora do ar tem que falhar rápido (open do pool e empréstimo de conexão), não esperar os 30s do default.
+DB_CONNECT_TIMEOUT = float(os.getenv("DB_CONNECT_TIMEOUT", "5"))
+# Depois de um open() que falhou, por quanto tempo as chamadas seguintes falham direto sem tentar de novo.
+DB_RETRY_COOLDOWN = float(os.getenv("DB_RETRY_COOLDOWN", "2"))
 
 # Sheets
 DEFAULT_SHEET_ID = (os.getenv("GSHEET_ID", "") or "").strip()
@@ -40,14 +81,19 @@ DEFAULT_SHEET_TAB = (os.getenv("SHEET_TAB_NAME", "Página1") or "Página1").stri
 # Mantemos compatibilidade com o nome antigo também.
 GOOGLE_SA_B64 = (
     os.getenv("GOOGLE_SERVICE_ACCOUNT_B64", "")
-    or os.getenv("GOOGLE_SERVICE_ACCOUNT_B64", "")
     or os.getenv("GOOGLE_SA_B64", "")
 ).strip()
 
+# Lido uma vez: sem service account não há export, nem precisa olhar a planilha da empresa.
+SHEETS_EXPORT_ENABLED = bool(GOOGLE_SA_B64)
+
 SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
+SHEETS_API_URL = "https://sheets.googleapis.com/v4/spreadsheets"
+SHEETS_HTTP_TIMEOUT = float(os.getenv("SHEETS_HTTP_TIMEOUT", "15"))
 
 # Admin token (opcional)
 ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+_ADMIN_TOKEN_BYTES = ADMIN_TOKEN.encode("utf-8")
 
 app = FastAPI(title="Contact Solution (Multi-Company)")
 
@@ -55,10 +101,87 @@ app = FastAPI(title="Contact Solution (Multi-Company)")
 # ---------------------------
 # DB helpers
 # ---------------------------
+_db_pool_cache: Dict[str, Any] = {"pool": None, "opening": None, "error": None, "failed_at": 0.0}
+_db_pool_lock = threading.Lock()
+
+
+def _get_db_pool() -> ConnectionPool:
+    pool = _db_pool_cache["pool"]
+    if pool is not None:
+        return pool
+
+    # O lock só decide quem abre; a espera do open() acontece fora dele.
+    with _db_pool_lock:
+        pool = _db_pool_cache["pool"]
+        if pool is not None:
+            return pool
+
+        if not DATABASE_URL:
+            raise RuntimeError("DATABASE_URL ausente")
+
+        # Banco fora do ar: quem chega logo depois de uma falha desiste na hora, sem esperar outro open().
+        err = _db_pool_cache["error"]
+        if err is not None and time.monotonic() - _db_pool_cache["failed_at"] < DB_RETRY_COOLDOWN:
+            raise PoolTimeout(f"banco indisponível: {err}") from err
+
+        opening = _db_pool_cache["opening"]
+        owner = opening is None
+        if owner:
+            opening = threading.Event()
+            _db_pool_cache["opening"] = opening
+
+    if not owner:
+        # Outro thread já está abrindo: espera o resultado dele em vez de abrir um segundo pool.
+        opening.wait(DB_CONNECT_TIMEOUT + 1)
+        pool = _db_pool_cache["pool"]
+        if pool is not None:
+            return pool
+        err = _db_pool_cache["error"]
+        raise PoolTimeout(f"banco indisponível: {err or 'falha ao abrir o pool'}") from err
+
+    # Criado no 1º uso (no startup do worker, depois do fork): cada processo tem as próprias conexões.
+    # `timeout` vale para pegar conexão do pool também, não só para o open.
+    pool = ConnectionPool(
+        DATABASE_URL,
+        min_size=DB_POOL_MIN,
+        max_size=DB_POOL_MAX,
+        timeout=DB_CONNECT_TIMEOUT,
+        kwargs={"row_factory": dict_row, "connect_timeout": max(1, int(DB_CONNECT_TIMEOUT))},
+        name="contact-solution",
+        open=False,
+    )
+    try:
+        pool.open(wait=True, timeout=DB_CONNECT_TIMEOUT)
+    except PoolTimeout as e:
+        # Não guarda um pool sem conexão: passado o cooldown, a próxima chamada tenta de novo do zero.
+        pool.close()
+        with _db_pool_lock:
+            _db_pool_cache["error"] = e
+            _db_pool_cache["failed_at"] = time.monotonic()
+            _db_pool_cache["opening"] = None
+        opening.set()
+        raise
+    except BaseException:
+        pool.close()
+        with _db_pool_lock:
+            _db_pool_cache["opening"] = None
+        opening.set()
+        raise
+
+    with _db_pool_lock:
+        _db_pool_cache["pool"] = pool
+        _db_pool_cache["error"] = None
+        _db_pool_cache["opening"] = None
+    opening.set()
+    return pool
+
+
 def db_conn():
-    if not DATABASE_URL:
-        raise RuntimeError("DATABASE_URL ausente")
-    return psycopg.connect(DATABASE_URL, row_factory=dict_row)
+    """
+    Conexão emprestada do pool (sem handshake TCP/TLS/auth por chamada).
+    No `with`: commit se deu certo, rollback se levantou, e a conexão volta pro pool.
+    """
+    return _get_db_pool().connection()
 
 
 def ensure_tables_and_migrate():
@@ -114,6 +237,7 @@ def ensure_tables_and_migrate():
       phone text not null,
       direction text not null, -- 'in' | 'out'
       text text not null,
+      wamid text, -- id da mensagem na Meta (só 'in'); único por empresa = dedup de retries entre workers
       created_at timestamptz not null default now()
     );
 
@@ -142,6 +266,10 @@ def ensure_tables_and_migrate():
         "alter table quotes add column if not exists is_returning boolean not null default false",
         "alter table quotes add column if not exists status text not null default 'ok'",
         "alter table quotes add column if not exists created_at timestamptz not null default now()",
+
+        # messages (depois do alter: em DB antigo a coluna ainda não existe quando o DDL roda)
+        "alter table messages add column if not exists wamid text",
+        "create unique index if not exists uq_messages_company_wamid on messages(company_id, wamid) where wamid is not null",
     ]
 
     try:
@@ -150,42 +278,125 @@ def ensure_tables_and_migrate():
                 cur.execute(ddl)
                 for m in migrations:
                     try:
-                        cur.execute(m)
-                    except Exception:
+                        # savepoint por migração: se uma falhar, as seguintes (e o DDL acima) não se perdem
+                        with conn.transaction():
+                            cur.execute(m)
+                    except psycopg.Error:
                         # se a tabela ainda não existir em um DB totalmente novo, ignore
                         pass
             conn.commit()
         logger.info("DB OK: tabelas garantidas + migração aplicada.")
-    except Exception as e:
-        logger.exception(f"Falha ao criar/verificar tabelas: {e}")
+    except psycopg.Error as e:
+        logger.exception("Falha ao criar/verificar tabelas: %s", e)
+
+
+def _check_env() -> None:
+    """
+    Confere a configuração uma vez no boot e avisa no log: as rotas usam as constantes
+    já resolvidas acima em vez de revalidar env a cada request.
+    """
+    if not DATABASE_URL:
+        logger.error("DATABASE_URL ausente: webhook e admin vão falhar até configurar.")
+    if not VERIFY_TOKEN:
+        logger.warning("VERIFY_TOKEN ausente: a verificação do webhook pela Meta vai falhar.")
+    if not ADMIN_TOKEN:
+        logger.warning("ADMIN_TOKEN ausente: rotas /admin estão abertas.")
+    if SHEETS_EXPORT_ENABLED:
+        logger.info("Export pro Sheets ativo (planilha padrão: %s)", DEFAULT_SHEET_ID or "-")
+    else:
+        logger.info("GOOGLE_SERVICE_ACCOUNT_B64 ausente: export pro Sheets desativado.")
 
 
 @app.on_event("startup")
 def _startup():
+    _check_env()
     ensure_tables_and_migrate()
+    _start_export_worker()
+
+
+@app.on_event("shutdown")
+def _shutdown():
+    _stop_export_worker()
+    pool = _db_pool_cache["pool"]
+    if pool is not None:
+        pool.close()
 
 
 # ---------------------------
 # Helpers - Sheets
 # ---------------------------
-def _normalize_b64(s: str) -> str:
-    s = (s or "").strip().replace("\n", "").replace("\r", "").replace(" ", "")
-    missing = len(s) % 4
-    if missing:
-        s += "=" * (4 - missing)
-    return s
+_B64_JUNK = b"\r\n\t \x00"
+
+
+def _normalize_b64(s: str) -> bytes:
+    # Uma passada só (translate em C) tirando quebras/espaços; depois completa o padding.
+    b = (s or "").encode("ascii", "ignore").translate(None, _B64_JUNK)
+    return b + b"=" * (-len(b) % 4)
+
+
+# Credenciais e sessão HTTP do Sheets montadas uma única vez por processo.
+# O google-auth renova o token sozinho quando expira; não precisa reconstruir nada.
+_sheets_client_cache: Dict[str, Any] = {"creds": None, "session": None}
+_sheets_client_lock = threading.RLock()
+
+# O que o cliente do Sheets pode levantar: auth/token, HTTP (inclui raise_for_status),
+# base64/JSON inválido (ValueError) e config ausente (RuntimeError).
+_SHEETS_ERRORS = (GoogleAuthError, requests.RequestException, ValueError, RuntimeError)
 
 
-def _get_sheets_service():
-    if not GOOGLE_SA_B64:
-        raise RuntimeError("GOOGLE_SERVICE_ACCOUNT_B64 ausente")
+def _get_sheets_credentials():
+    creds = _sheets_client_cache["creds"]
+    if creds is not None:
+        return creds
 
-    b64 = _normalize_b64(GOOGLE_SA_B64)
-    raw = base64.b64decode(b64).decode("utf-8")
-    info = json.loads(raw)
+    with _sheets_client_lock:
+        creds = _sheets_client_cache["creds"]
+        if creds is not None:
+            return creds
 
-    creds = service_account.Credentials.from_service_account_info(info, scopes=SCOPES)
-    return build("sheets", "v4", credentials=creds, cache_discovery=False)
+        if not GOOGLE_SA_B64:
+            raise RuntimeError("GOOGLE_SERVICE_ACCOUNT_B64 ausente")
+
+        b64 = _normalize_b64(GOOGLE_SA_B64)
+        info = orjson.loads(base64.b64decode(b64))  # orjson aceita bytes: sem decode utf-8 intermediário
+
+        creds = service_account.Credentials.from_service_account_info(info, scopes=SCOPES)
+        _sheets_client_cache["creds"] = creds
+        return creds
+
+
+def _get_sheets_session() -> AuthorizedSession:
+    session = _sheets_client_cache["session"]
+    if session is not None:
+        return session
+
+    with _sheets_client_lock:
+        session = _sheets_client_cache["session"]
+        if session is not None:
+            return session
+
+        creds = _get_sheets_credentials()
+        # REST direto no Sheets (só usamos spreadsheets.get e values.append): sem discovery/httplib2.
+        # AuthorizedSession é um requests.Session: mantém a conexão aberta com sheets.googleapis.com
+        # entre exports e põe/renova o Bearer sozinha (inclusive repetindo a chamada num 401).
+        session = AuthorizedSession(creds)
+        _sheets_client_cache["session"] = session
+        return session
+
+
+def _warm_sheets_session() -> None:
+    """
+    Monta credenciais/sessão e já busca o 1º token OAuth, pra o primeiro export não pagar isso.
+    Falha aqui só loga: o export tenta de novo normalmente (e aí loga o erro real).
+    """
+    try:
+        session = _get_sheets_session()
+        # Transporte próprio (não a AuthorizedSession): senão o before_request dela já renova o token
+        # e este refresh faria uma 2ª ida ao endpoint de token.
+        session.credentials.refresh(GoogleAuthRequest())
+        logger.info("[EXPORT] token do Sheets pronto")
+    except _SHEETS_ERRORS as e:
+        logger.warning("Não consegui pré-aquecer o cliente do Sheets: %s", e)
 
 
 def _clean_sheet_title(s: str) -> str:
@@ -203,7 +414,7 @@ def _simplify(s: str) -> str:
     return s
 
 
-def _resolve_sheet_tab(service, sheet_id: str, desired_tab: str) -> str:
+def _resolve_sheet_tab(session: AuthorizedSession, sheet_id: str, desired_tab: str) -> str:
     """
     Blindagem real:
     - Se a aba não existir (por espaço/acentos/caps/renomeada), pega a correta ou cai na primeira aba existente.
@@ -211,10 +422,13 @@ def _resolve_sheet_tab(service, sheet_id: str, desired_tab: str) -> str:
     """
     desired_tab = _clean_sheet_title(desired_tab or "Página1")
 
-    meta = service.spreadsheets().get(
-        spreadsheetId=sheet_id,
-        fields="sheets(properties(title))"
-    ).execute()
+    resp = session.get(
+        f"{SHEETS_API_URL}/{quote(sheet_id, safe='')}",
+        params={"fields": "sheets(properties(title))"},
+        timeout=SHEETS_HTTP_TIMEOUT,
+    )
+    resp.raise_for_status()
+    meta = orjson.loads(resp.content)
 
     titles = [sh["properties"]["title"] for sh in (meta.get("sheets") or [])]
     if not titles:
@@ -234,47 +448,206 @@ def _resolve_sheet_tab(service, sheet_id: str, desired_tab: str) -> str:
     return titles[0]
 
 
-def append_to_sheets(sheet_id: str, sheet_tab: str, row: List[Any]) -> Dict[str, Any]:
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+
+def append_to_sheets(sheet_id: str, sheet_tab: str, rows: List[List[Any]]) -> Dict[str, Any]:
     """
     Exporta para A:M (13 colunas), de acordo com sua planilha nova.
+    Recebe várias linhas: um único append no Sheets para o lote inteiro.
     """
     if not sheet_id:
         raise RuntimeError("sheet_id ausente para export")
 
-    service = _get_sheets_service()
+    session = _get_sheets_session()
 
     # >>> BLINDAGEM AQUI: resolve a aba certa mesmo com espaço/acentos/capslock
-    resolved_tab = _resolve_sheet_tab(service, sheet_id, sheet_tab or "Página1")
+    resolved_tab = _resolve_sheet_tab(session, sheet_id, sheet_tab or "Página1")
 
     rng = f"{resolved_tab}!A:M"
 
-    body = {"values": [row]}
-    result = (
-        service.spreadsheets()
-        .values()
-        .append(
-            spreadsheetId=sheet_id,
-            range=rng,
-            valueInputOption="USER_ENTERED",
-            insertDataOption="INSERT_ROWS",
-            body=body,
-        )
-        .execute()
+    resp = session.post(
+        f"{SHEETS_API_URL}/{quote(sheet_id, safe='')}/values/{quote(rng, safe='')}:append",
+        # fields: o Sheets devolve só o que o log usa, não o eco completo do append
+        params={
+            "valueInputOption": "RAW",  # linhas geradas pelo sistema: sem parse/fórmulas do lado do Sheets
+            "insertDataOption": "INSERT_ROWS",
+            "fields": "updates(updatedRange,updatedRows)",
+        },
+        data=orjson.dumps({"values": rows}),  # orjson em vez do json da stdlib que o requests usaria
+        headers=_JSON_HEADERS,
+        timeout=SHEETS_HTTP_TIMEOUT,
     )
+    resp.raise_for_status()
+    result = orjson.loads(resp.content)
     updates = result.get("updates", {})
     return {"updatedRange": updates.get("updatedRange"), "updatedRows": updates.get("updatedRows"), "tab_used": resolved_tab}
 
 
+# ---------------------------
+# Export em lote (fila + thread de fundo)
+# ---------------------------
+# O webhook só enfileira a linha; a thread junta o que estiver na fila e faz um append por planilha/aba.
+EXPORT_QUEUE_MAX = int(os.getenv("EXPORT_QUEUE_MAX", "1000"))
+EXPORT_BATCH_MAX = int(os.getenv("EXPORT_BATCH_MAX", "50"))
+# Depois da 1ª linha, espera até N segundos juntando mais (ou até encher o lote) antes do append.
+EXPORT_FLUSH_SECONDS = float(os.getenv("EXPORT_FLUSH_SECONDS", "2.0"))
+# Falha transitória (429/503/não conectou) tenta de novo com espera exponencial: 1s, 2s, 4s...
+EXPORT_RETRIES = int(os.getenv("EXPORT_RETRIES", "3"))
+EXPORT_RETRY_BASE_SECONDS = float(os.getenv("EXPORT_RETRY_BASE_SECONDS", "1.0"))
+
+# No shutdown, tempo máximo esperando a thread mandar o que ainda tem (inclui retries).
+EXPORT_SHUTDOWN_TIMEOUT = float(os.getenv("EXPORT_SHUTDOWN_TIMEOUT", "15"))
+
+_export_queue: "queue.Queue[Any]" = queue.Queue(maxsize=EXPORT_QUEUE_MAX)
+_EXPORT_STOP = object()  # sentinela: a thread manda o lote pendente e termina
+_export_worker_state: Dict[str, Any] = {"thread": None}
+_export_worker_lock = threading.Lock()
+
+
+def enqueue_export(sheet_id: str, sheet_tab: str, row: List[Any]) -> None:
+    """
+    Não bloqueia: levanta queue.Full se a fila estiver cheia.
+    """
+    _export_queue.put_nowait((sheet_id, sheet_tab, row))
+
+
+def _drain_export_batch(first: tuple, linger: float = 0.0) -> tuple:
+    """
+    Junta linhas a partir de `first`. Devolve (lote, parar): parar=True se a sentinela chegou.
+    """
+    batch = [first]
+    deadline = time.monotonic() + linger
+    while len(batch) < EXPORT_BATCH_MAX:
+        remaining = deadline - time.monotonic()
+        try:
+            if remaining > 0:
+                item = _export_queue.get(timeout=remaining)
+            else:
+                item = _export_queue.get_nowait()
+        except queue.Empty:
+            break
+        if item is _EXPORT_STOP:
+            return batch, True
+        batch.append(item)
+    return batch, False
+
+
+def _is_retryable_export_error(e: Exception) -> bool:
+    """
+    values.append não é idempotente: só repete quando dá pra ter certeza (ou quase) de que nada entrou.
+    - não chegou a conectar (timeout de conexão, DNS, recusa): o request nem saiu
+    - 429 (quota) e 503 (indisponível): o Sheets recusou antes de aplicar
+    Read timeout, conexão caída no meio e outros 5xx ficam de fora: o append pode ter sido
+    aplicado, e repetir duplicaria as linhas na planilha.
+    """
+    if isinstance(e, requests.ConnectTimeout):
+        return True
+    if isinstance(e, requests.ConnectionError):
+        reason = getattr(e.args[0], "reason", None) if e.args else None
+        return isinstance(reason, NewConnectionError)
+    resp = getattr(e, "response", None)
+    return resp is not None and resp.status_code in (429, 503)
+
+
+def _export_batch(batch: List[tuple]) -> None:
+    groups: Dict[tuple, List[List[Any]]] = {}
+    for sheet_id, sheet_tab, row in batch:
+        groups.setdefault((sheet_id, sheet_tab), []).append(row)
+
+    for (sheet_id, sheet_tab), rows in groups.items():
+        for attempt in range(EXPORT_RETRIES + 1):
+            try:
+                info = append_to_sheets(sheet_id, sheet_tab, rows)
+                logger.info("[EXPORT] %d linha(s) -> %s", len(rows), info.get("updatedRange"))
+                break
+            except _SHEETS_ERRORS as e:
+                if attempt < EXPORT_RETRIES and _is_retryable_export_error(e):
+                    delay = EXPORT_RETRY_BASE_SECONDS * (2 ** attempt)
+                    logger.warning(
+                        "Export pro Sheets falhou (tentativa %d/%d), tentando de novo em %.1fs: %s",
+                        attempt + 1, EXPORT_RETRIES + 1, delay, e,
+                    )
+                    time.sleep(delay)
+                    continue
+                logger.error("Falha no export pro Sheets (%d linha(s) perdidas): %s", len(rows), e)
+                break
+
+
+def _export_worker_loop() -> None:
+    # Pré-aquece na própria thread de export: não atrasa o startup nem o event loop.
+    if SHEETS_EXPORT_ENABLED:
+        _warm_sheets_session()
+    stop = False
+    while not stop:
+        first = _export_queue.get()
+        if first is _EXPORT_STOP:
+            stop = True
+            batch: List[tuple] = []
+        else:
+            batch, stop = _drain_export_batch(first, linger=EXPORT_FLUSH_SECONDS)
+        if stop:
+            # Encerrando: junta também o que ainda estiver na fila, sem esperar mais nada.
+            while True:
+                try:
+                    item = _export_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is not _EXPORT_STOP:
+                    batch.append(item)
+        if not batch:
+            continue
+        try:
+            _export_batch(batch)
+        except Exception:
+            # Rede de segurança da thread: um erro inesperado perde o lote, mas não mata o export.
+            logger.exception("Erro inesperado no export pro Sheets (%d linha(s) perdidas)", len(batch))
+
+
+def _start_export_worker() -> None:
+    with _export_worker_lock:
+        if _export_worker_state["thread"] is not None:
+            return
+        t = threading.Thread(target=_export_worker_loop, name="sheets-export", daemon=True)
+        t.start()
+        _export_worker_state["thread"] = t
+
+
+def _stop_export_worker() -> None:
+    """
+    Chamado no shutdown: a própria thread de export manda o lote em andamento e o resto da fila
+    (nada de segunda thread usando a mesma sessão do Sheets em paralelo).
+    """
+    with _export_worker_lock:
+        t = _export_worker_state["thread"]
+        if t is None:
+            return
+        _export_worker_state["thread"] = None
+
+    try:
+        _export_queue.put(_EXPORT_STOP, timeout=EXPORT_SHUTDOWN_TIMEOUT)
+    except queue.Full:
+        logger.error("Fila de export cheia no shutdown; linhas pendentes podem se perder.")
+        return
+    t.join(EXPORT_SHUTDOWN_TIMEOUT)
+    if t.is_alive():
+        logger.error("Export pro Sheets não terminou em %.0fs no shutdown; linhas pendentes podem se perder.",
+                     EXPORT_SHUTDOWN_TIMEOUT)
+
+
 # ---------------------------
 # Helpers - fluxo / validações
 # ---------------------------
+_NON_DIGIT_RE = re.compile(r"\D")
+_EMAIL_RE = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
+
+
 def _is_valid_email(s: str) -> bool:
-    s = (s or "").strip()
-    return "@" in s and "." in s and len(s) >= 6
+    return bool(_EMAIL_RE.match((s or "").strip()))
 
 
 def _normalize_cep_digits_only(s: str) -> str:
-    return "".join(ch for ch in (s or "") if ch.isdigit())
+    return _NON_DIGIT_RE.sub("", s or "")
 
 
 def _normalize_cep(s: str) -> str:
@@ -284,25 +657,46 @@ def _normalize_cep(s: str) -> str:
     return ""
 
 
-def extract_whatsapp_message(payload: Dict[str, Any]) -> Optional[Dict[str, str]]:
+def _list_at(d: Dict[str, Any], key: str) -> list:
+    v = d.get(key)
+    return v if isinstance(v, list) else []
+
+
+def extract_whatsapp_messages(payload: Dict[str, Any]) -> List[Dict[str, str]]:
     """
     Payload no formato WhatsApp Cloud API (ou simulado via Postman).
+    A Meta pode agrupar várias entries/changes/mensagens no mesmo webhook: devolve todas, na ordem.
+    Qualquer pedaço fora do formato (tipo errado) é só ignorado: payload malformado vira "ignored", não 500.
     """
-    try:
-        entry = (payload.get("entry") or [])[0]
-        changes = (entry.get("changes") or [])[0]
-        value = changes.get("value") or {}
-        messages = value.get("messages") or []
-        if not messages:
-            return None
-        msg = messages[0] or {}
-        sender = (msg.get("from") or "").strip()
-        text = ((msg.get("text") or {}).get("body") or "").strip()
-        if not sender:
-            return None
-        return {"from": sender, "text": text}
-    except Exception:
-        return None
+    if not isinstance(payload, dict):
+        return []
+
+    out = []
+    for entry in _list_at(payload, "entry"):
+        if not isinstance(entry, dict):
+            continue
+        for change in _list_at(entry, "changes"):
+            if not isinstance(change, dict):
+                continue
+            value = change.get("value")
+            if not isinstance(value, dict):
+                continue
+            for msg in _list_at(value, "messages"):
+                if not isinstance(msg, dict):
+                    continue
+                sender = msg.get("from")
+                if not isinstance(sender, str) or not sender.strip():
+                    continue
+                # sem texto (ex.: mídia) vira "", mas texto/body de tipo errado descarta a mensagem
+                text_obj = msg.get("text") or {}
+                if not isinstance(text_obj, dict):
+                    continue
+                body = text_obj.get("body") or ""
+                if not isinstance(body, str):
+                    continue
+                mid = msg.get("id")
+                out.append({"id": mid if isinstance(mid, str) else "", "from": sender.strip(), "text": body.strip()})
+    return out
 
 
 # ---------------------------
@@ -312,32 +706,91 @@ def require_admin(request: Request):
     if not ADMIN_TOKEN:
         return
     token = request.headers.get("x-admin-token", "")
-    if token != ADMIN_TOKEN:
+    # comparação em tempo constante (não vaza o token por timing)
+    if not hmac.compare_digest(token.encode("utf-8"), _ADMIN_TOKEN_BYTES):
         raise HTTPException(status_code=401, detail="Unauthorized")
 
 
+# Empresas quase nunca mudam: cache por processo com TTL, pra não ir ao banco em todo webhook.
+# O admin invalida no próprio worker; os outros workers pegam a mudança em até COMPANY_CACHE_TTL.
+COMPANY_CACHE_TTL = float(os.getenv("COMPANY_CACHE_TTL", "60"))
+COMPANY_CACHE_MAX = 1024
+_company_cache: "OrderedDict[str, tuple]" = OrderedDict()
+_company_cache_lock = threading.Lock()
+
+
 def get_company(company_id: str) -> Dict[str, Any]:
+    now = time.monotonic()
+    with _company_cache_lock:
+        hit = _company_cache.get(company_id)
+        if hit is not None and hit[0] > now:
+            return hit[1]
+
     with db_conn() as conn:
         with conn.cursor() as cur:
-            cur.execute("select * from companies where id = %s", (company_id,))
+            cur.execute("select * from companies where id = %s", (company_id,), prepare=True)
             row = cur.fetchone()
             if not row:
                 raise HTTPException(status_code=404, detail="company_id não encontrado")
+
+    with _company_cache_lock:
+        _company_cache[company_id] = (now + COMPANY_CACHE_TTL, row)
+        _company_cache.move_to_end(company_id)
+        while len(_company_cache) > COMPANY_CACHE_MAX:
+            _company_cache.popitem(last=False)
+    return row
+
+
+def invalidate_company(company_id: str) -> None:
+    with _company_cache_lock:
+        _company_cache.pop(company_id, None)
+
+
+def upsert_company(company_id: str, name: str, sheet_id: str, sheet_tab: str) -> Dict[str, Any]:
+    with db_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                insert into companies (id, name, sheet_id, sheet_tab)
+                values (%s, %s, %s, %s)
+                on conflict (id) do update set
+                  name = excluded.name,
+                  sheet_id = excluded.sheet_id,
+                  sheet_tab = excluded.sheet_tab
+                returning *
+                """,
+                (company_id, name, sheet_id, sheet_tab),
+            )
+            row = cur.fetchone()
+            conn.commit()
             return row
 
 
-def upsert_conversation(company_id: str, phone: str) -> Dict[str, Any]:
+def upsert_conversation(company_id: str, phone: str, inbound_text: str, wamid: str = "") -> Optional[Dict[str, Any]]:
+    """
+    Grava também a mensagem recebida no mesmo statement (1 ida ao DB em vez de 2).
+    Com wamid: se a mensagem já foi gravada (retry da Meta, em qualquer worker), não toca na
+    conversa e devolve None. O índice único serializa entregas concorrentes do mesmo wamid.
+    """
     with db_conn() as conn:
         with conn.cursor() as cur:
             cur.execute(
                 """
+                with logged as (
+                  insert into messages (company_id, phone, direction, text, wamid)
+                  values (%s, %s, 'in', %s, nullif(%s, ''))
+                  on conflict (company_id, wamid) where wamid is not null do nothing
+                  returning 1
+                )
                 insert into conversations (company_id, phone)
-                values (%s, %s)
+                select %s, %s
+                where exists (select 1 from logged)
                 on conflict (company_id, phone) do update
                 set updated_at = now()
                 returning *
                 """,
-                (company_id, phone),
+                (company_id, phone, inbound_text, wamid, company_id, phone),
+                prepare=True,
             )
             row = cur.fetchone()
             conn.commit()
@@ -345,25 +798,35 @@ def upsert_conversation(company_id: str, phone: str) -> Dict[str, Any]:
 
 
 def update_conversation(company_id: str, phone: str, **fields) -> Dict[str, Any]:
-    allowed = {"step", "nome", "email", "cep_padrao", "status"}
-    sets = []
-    vals = []
-    for k, v in fields.items():
-        if k in allowed:
-            sets.append(f"{k} = %s")
-            vals.append(v)
-    sets.append("updated_at = now()")
-    vals.extend([company_id, phone])
-
-    q = f"""
-    update conversations
-    set {", ".join(sets)}
-    where company_id = %s and phone = %s
-    returning *
+    """
+    SQL fixo (campo não informado = None = mantém o valor atual): o texto do statement não muda
+    entre chamadas, então o Postgres prepara uma vez por conexão do pool e reaproveita o plano.
     """
     with db_conn() as conn:
         with conn.cursor() as cur:
-            cur.execute(q, tuple(vals))
+            cur.execute(
+                """
+                update conversations
+                set step = coalesce(%s, step),
+                    nome = coalesce(%s, nome),
+                    email = coalesce(%s, email),
+                    cep_padrao = coalesce(%s, cep_padrao),
+                    status = coalesce(%s, status),
+                    updated_at = now()
+                where company_id = %s and phone = %s
+                returning *
+                """,
+                (
+                    fields.get("step"),
+                    fields.get("nome"),
+                    fields.get("email"),
+                    fields.get("cep_padrao"),
+                    fields.get("status"),
+                    company_id,
+                    phone,
+                ),
+                prepare=True,
+            )
             row = cur.fetchone()
             conn.commit()
             return row
@@ -375,54 +838,66 @@ def log_message(company_id: str, phone: str, direction: str, text: str) -> None:
             cur.execute(
                 "insert into messages (company_id, phone, direction, text) values (%s, %s, %s, %s)",
                 (company_id, phone, direction, text),
+                prepare=True,
             )
             conn.commit()
 
 
-def get_next_quote_number(company_id: str, phone: str) -> int:
-    with db_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute(
-                "select coalesce(max(quote_number), 0) as mx from quotes where company_id=%s and phone=%s",
-                (company_id, phone),
-            )
-            row = cur.fetchone()
-            mx = int((row or {}).get("mx") or 0)
-            return mx + 1
-
-
-def insert_quote(
+def save_quote_and_complete(
     company_id: str,
     phone: str,
-    quote_number: int,
     produto: str,
     cep_usado: str,
     cep_alterado: bool,
     salvou_cep_padrao: bool,
     is_returning: bool,
-    status: str = "ok",
+    reply: str,
 ) -> Dict[str, Any]:
+    """
+    Fechamento do orçamento num único statement (1 ida ao banco, 1 transação):
+    - insere a quote com o próximo quote_number calculado no próprio insert
+    - marca a conversa como completed e step=produto
+    - registra a resposta final em messages
+    Se qualquer parte falhar, nada é gravado.
+    """
     with db_conn() as conn:
         with conn.cursor() as cur:
             cur.execute(
                 """
-                insert into quotes
-                  (company_id, phone, quote_number, produto, cep_usado, cep_alterado, salvou_cep_padrao, is_returning, status)
-                values
-                  (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-                returning *
+                with q as (
+                  insert into quotes
+                    (company_id, phone, quote_number, produto, cep_usado, cep_alterado, salvou_cep_padrao, is_returning, status)
+                  select %s, %s, coalesce(max(quote_number), 0) + 1, %s, %s, %s, %s, %s, 'ok'
+                  from quotes
+                  where company_id = %s and phone = %s
+                  returning *
+                ), completed as (
+                  update conversations
+                  set step = 'produto', status = 'completed', updated_at = now()
+                  where company_id = %s and phone = %s
+                ), logged as (
+                  insert into messages (company_id, phone, direction, text)
+                  values (%s, %s, 'out', %s)
+                )
+                select * from q
                 """,
                 (
                     company_id,
                     phone,
-                    quote_number,
                     produto or "",
                     cep_usado or "",
                     bool(cep_alterado),
                     bool(salvou_cep_padrao),
                     bool(is_returning),
-                    status,
+                    company_id,
+                    phone,
+                    company_id,
+                    phone,
+                    company_id,
+                    phone,
+                    reply,
                 ),
+                prepare=True,
             )
             row = cur.fetchone()
             conn.commit()
@@ -432,24 +907,59 @@ def insert_quote(
 # ---------------------------
 # Rotas básicas
 # ---------------------------
+# Corpos fixos já serializados. O Response é criado por request (barato) porque o Starlette
+# repassa a lista de headers da instância no send, e um middleware poderia mutá-la.
+_ROOT_BODY = orjson.dumps({
+    "status": "ok",
+    "service": "contact-solution-multi",
+    "endpoints": [
+        "/health",
+        "/webhook/{company_id}",
+        "/admin/companies",
+        "/admin/leads/{company_id}",
+        "/admin/quotes/{company_id}",
+    ],
+})
+_HEALTH_BODY = orjson.dumps({"status": "ok"})
+_IGNORED_BODY = orjson.dumps({"status": "ignored"})
+_DUPLICATE_BODY = orjson.dumps({"status": "duplicate"})
+_INVALID_JSON_BODY = orjson.dumps({"status": "error", "error": "JSON inválido"})
+
+
 @app.get("/")
 def root():
-    return {
-        "status": "ok",
-        "service": "contact-solution-multi",
-        "endpoints": [
-            "/health",
-            "/webhook/{company_id}",
-            "/admin/companies",
-            "/admin/leads/{company_id}",
-            "/admin/quotes/{company_id}",
-        ],
-    }
+    return Response(_ROOT_BODY, media_type="application/json")
 
 
 @app.get("/health")
 def health():
-    return {"status": "ok"}
+    return Response(_HEALTH_BODY, media_type="application/json")
+
+
+class _HealthShortCircuit:
+    """
+    Health check do Render bate a cada poucos segundos: responde GET/HEAD /health direto no ASGI,
+    sem roteamento/dependências do FastAPI. A rota acima continua existindo (docs/openapi).
+    """
+
+    _content_length = str(len(_HEALTH_BODY)).encode()
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] == "/health" and scope["method"] in ("GET", "HEAD"):
+            await send({
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [(b"content-type", b"application/json"), (b"content-length", self._content_length)],
+            })
+            await send({"type": "http.response.body", "body": b"" if scope["method"] == "HEAD" else _HEALTH_BODY})
+            return
+        await self.app(scope, receive, send)
+
+
+app.add_middleware(_HealthShortCircuit)
 
 
 # ---------------------------
@@ -458,7 +968,12 @@ def health():
 @app.post("/admin/companies")
 async def admin_create_company(request: Request):
     require_admin(request)
-    body = await request.json()
+    try:
+        body = orjson.loads(await request.body())
+    except orjson.JSONDecodeError:
+        return Response(_INVALID_JSON_BODY, status_code=400, media_type="application/json")
+    if not isinstance(body, dict):
+        return Response(_INVALID_JSON_BODY, status_code=400, media_type="application/json")
 
     company_id = (body.get("id") or "").strip()
     name = (body.get("name") or "").strip()
@@ -468,23 +983,9 @@ async def admin_create_company(request: Request):
     if not company_id or not name:
         return JSONResponse(status_code=400, content={"status": "error", "error": "id e name são obrigatórios"})
 
-    with db_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute(
-                """
-                insert into companies (id, name, sheet_id, sheet_tab)
-                values (%s, %s, %s, %s)
-                on conflict (id) do update set
-                  name = excluded.name,
-                  sheet_id = excluded.sheet_id,
-                  sheet_tab = excluded.sheet_tab
-                returning *
-                """,
-                (company_id, name, sheet_id, sheet_tab),
-            )
-            row = cur.fetchone()
-            conn.commit()
-
+    # Rota é async (lê o body); o insert síncrono vai pro pool de threads padrão, fora do event loop.
+    row = await asyncio.get_running_loop().run_in_executor(None, upsert_company, company_id, name, sheet_id, sheet_tab)
+    invalidate_company(company_id)
     return {"status": "ok", "company": row}
 
 
@@ -544,7 +1045,12 @@ async def webhook_verify(request: Request):
     token = qp.get("hub.verify_token")
     challenge = qp.get("hub.challenge")
 
-    if mode == "subscribe" and token and token == VERIFY_TOKEN and challenge:
+    if (
+        mode == "subscribe"
+        and token
+        and challenge
+        and hmac.compare_digest(token.encode("utf-8"), _VERIFY_TOKEN_BYTES)
+    ):
         return PlainTextResponse(challenge)
 
     return JSONResponse(status_code=403, content={"status": "error", "error": "Verification failed"})
@@ -553,214 +1059,339 @@ async def webhook_verify(request: Request):
 # ---------------------------
 # Webhook Multiempresa (POST)
 # ---------------------------
+# Fluxo é todo I/O síncrono (Postgres): roda num pool de threads, fora do event loop.
+MESSAGE_CONCURRENCY = int(os.getenv("MESSAGE_CONCURRENCY", "8"))
+_message_executor = ThreadPoolExecutor(max_workers=MESSAGE_CONCURRENCY, thread_name_prefix="webhook")
+
+# Locks por telefone (fixos, por hash) pra dois webhooks do mesmo número não correrem juntos.
+_PHONE_LOCKS = [threading.Lock() for _ in range(64)]
+
+
+def _phone_lock(company_id: str, phone: str) -> threading.Lock:
+    return _PHONE_LOCKS[hash((company_id, phone)) % len(_PHONE_LOCKS)]
+
+
+# Retries da Meta reentregam a mesma mensagem (mesmo wamid, no mesmo corpo ou em outro) e, com
+# vários workers, quase sempre em outro processo. Quem garante o dedup é o índice único de
+# messages.wamid (ver upsert_conversation); estes caches são só o atalho local, sem ida ao banco.
+# Sem id (ex.: payload simulado) não há dedup: o mesmo texto em outro step é mensagem legítima.
+WEBHOOK_DEDUP_MAX = int(os.getenv("WEBHOOK_DEDUP_MAX", "4096"))
+_recent_message_ids: "OrderedDict[tuple, None]" = OrderedDict()
+# ids em processamento agora: uma reentrega concorrente do mesmo wamid não roda o fluxo de novo.
+# Só é mexido no event loop (sem await entre checar e reservar), então não precisa de lock.
+_inflight_message_ids: set = set()
+
+
+def _remember(lru: "OrderedDict[tuple, None]", key: tuple) -> None:
+    lru[key] = None
+    lru.move_to_end(key)
+    while len(lru) > WEBHOOK_DEDUP_MAX:
+        lru.popitem(last=False)
+
+
 @app.post("/webhook/{company_id}")
 async def webhook_receive(company_id: str, request: Request):
-    payload = await request.json()
-    msg = extract_whatsapp_message(payload)
+    body = await request.body()
+
+    try:
+        # application/jsonl: vários payloads (um por linha) num único POST
+        if request.headers.get("content-type", "").split(";", 1)[0].strip() == "application/jsonl":
+            payloads = [orjson.loads(line) for line in body.splitlines() if line.strip()]
+        else:
+            payloads = [orjson.loads(body)]
+    except orjson.JSONDecodeError:
+        return Response(_INVALID_JSON_BODY, status_code=400, media_type="application/json")
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("[WEBHOOK] company=%s payloads=%r", company_id, payloads)
+
+    msgs = [m for payload in payloads for m in extract_whatsapp_messages(payload)]
+
+    if not msgs:
+        return Response(_IGNORED_BODY, media_type="application/json")
+
+    fresh = []
+    msg_keys = set()
+    for m in msgs:
+        if m["id"]:
+            key = (company_id, m["id"])
+            if key in _recent_message_ids or key in _inflight_message_ids or key in msg_keys:
+                continue
+            msg_keys.add(key)
+        fresh.append(m)
+    if not fresh:
+        return Response(_DUPLICATE_BODY, media_type="application/json")
+    msgs = fresh
+
+    # Reserva antes de qualquer await; cada grupo grava os seus ids ao terminar, e o finally
+    # libera o que sobrou (grupos que falharam: o retry da Meta reprocessa só esses).
+    _inflight_message_ids.update(msg_keys)
+    try:
+        loop = asyncio.get_running_loop()
+        company = await loop.run_in_executor(_message_executor, get_company, company_id)
+
+        # Mesmo telefone: em ordem. Telefones diferentes: em paralelo.
+        by_phone: Dict[str, List[Dict[str, str]]] = {}
+        for m in msgs:
+            by_phone.setdefault(m["from"], []).append(m)
+
+        # return_exceptions: espera todos os grupos terminarem antes de liberar as reservas
+        groups = await asyncio.gather(
+            *(_run_phone_group(loop, company_id, company, phone, group) for phone, group in by_phone.items()),
+            return_exceptions=True,
+        )
+    finally:
+        _inflight_message_ids.difference_update(msg_keys)
 
-    if not msg:
-        return {"status": "ignored"}
+    for group in groups:
+        if isinstance(group, BaseException):
+            raise group
+    results = [r for group in groups for r in group]
 
-    phone = msg["from"]
-    text = (msg["text"] or "").strip()
-    now_iso = datetime.now(timezone.utc).isoformat()
+    # Response pronta (bytes do orjson): o FastAPI não passa o resultado pelo jsonable_encoder
+    if len(results) == 1:
+        return Response(orjson.dumps(results[0][1]), media_type="application/json")
+    payload = {"status": "ok", "results": [{"phone": phone, **r} for phone, r in results]}
+    return Response(orjson.dumps(payload), media_type="application/json")
 
-    company = get_company(company_id)
 
-    convo = upsert_conversation(company_id, phone)
+async def _run_phone_group(
+    loop: asyncio.AbstractEventLoop,
+    company_id: str,
+    company: Dict[str, Any],
+    phone: str,
+    msgs: List[Dict[str, str]],
+) -> List[tuple]:
+    results = await loop.run_in_executor(_message_executor, _handle_phone_messages, company_id, company, phone, msgs)
+    # só depois de processar: se o grupo falhou, os ids dele não entram no atalho local. O retry da Meta
+    # reprocessa o que não chegou a ser gravado em messages; o que já foi gravado o banco acusa como duplicado.
+    for m in msgs:
+        if m["id"]:
+            _remember(_recent_message_ids, (company_id, m["id"]))
+    return results
+
+
+def _handle_phone_messages(company_id: str, company: Dict[str, Any], phone: str, msgs: List[Dict[str, str]]) -> List[tuple]:
+    with _phone_lock(company_id, phone):
+        return [(phone, _handle_message(company_id, company, phone, m["text"], m["id"])) for m in msgs]
+
+
+# Templates das respostas de várias linhas (montados uma vez; por mensagem só .format)
+_CEP_CONFIRM_TMPL = (
+    "Show! Vou preparar o orçamento de *{produto}*.\n"
+    "Quer usar o seu CEP padrão *{cep_padrao}*?\n"
+    "Responda:\n"
+    "1 = Sim (usar padrão)\n"
+    "2 = Não (informar outro CEP)"
+)
+_CEP_SAVE_NOVO_TMPL = (
+    "Entendi ✅ Vou usar o CEP *{cep}*.\n"
+    "Quer salvar esse CEP como seu novo CEP padrão?\n"
+    "1 = Sim\n"
+    "2 = Não"
+)
+_CEP_SAVE_PRIMEIRO_TMPL = (
+    "Perfeito ✅ Vou usar o CEP *{cep}*.\n"
+    "Quer salvar esse CEP como padrão para próximos orçamentos?\n"
+    "1 = Sim\n"
+    "2 = Não"
+)
+_FINAL_TMPL = (
+    "Fechado, {nome} ✅\n"
+    "Já registrei seu interesse em *{produto}*.\n"
+    "CEP considerado: *{cep}*.\n\n"
+    "Um vendedor vai te chamar em breve com uma oferta preparada pra você. 🤝"
+)
+
+GREETINGS = frozenset({"oi", "olá", "ola", "bom dia", "boa tarde", "boa noite", "hello", "hi"})
+
+# Steps em que um lead já completed continua de onde está (senão volta pra produto)
+_COMPLETED_KEEP_STEPS = frozenset({"produto", "cep_confirm::", "cep::", "cep_save::"})
+
+
+def _handle_message(company_id: str, company: Dict[str, Any], phone: str, text: str, wamid: str = "") -> Dict[str, Any]:
+    # text já chega normalizado (str, sem espaços nas pontas) de extract_whatsapp_messages
+    convo = upsert_conversation(company_id, phone, inbound_text=text, wamid=wamid)
+    if convo is None:
+        # wamid já gravado por outra entrega (outro worker ou antes de um restart): não anda o step
+        logger.info("[FLOW] company=%s phone=%s wamid=%s duplicado, ignorado", company_id, phone, wamid)
+        return {"status": "duplicate"}
     step = (convo.get("step") or "nome").strip()
 
-    greetings = {"oi", "olá", "ola", "bom dia", "boa tarde", "boa noite", "hello", "hi"}
-
-    logger.info(f"[FLOW] company={company_id} phone={phone} step={step} status={convo.get('status')} text='{text}'")
-    log_message(company_id, phone, "in", text)
+    logger.info("[FLOW] company=%s phone=%s step=%s status=%s text='%s'", company_id, phone, step, convo.get("status"), text)
 
     is_completed = (convo.get("status") == "completed")
     has_profile = bool((convo.get("nome") or "").strip()) and bool((convo.get("email") or "").strip())
-    cep_padrao = (convo.get("cep_padrao") or "").strip()
 
     # Se já é completed, entra direto em orçamento (produto)
-    if is_completed and step not in {"produto", "cep_confirm::", "cep::", "cep_save::"}:
+    if is_completed and step not in _COMPLETED_KEEP_STEPS:
         convo = update_conversation(company_id, phone, step="produto", status="open")
         step = "produto"
 
-    # Step: NOME
-    if step == "nome":
-        if text.lower() in greetings:
-            reply = "Olá! 👋 Tudo bem? Qual é o seu nome?"
-            log_message(company_id, phone, "out", reply)
-            return {"status": "ok", "reply": reply}
+    ctx = {
+        "company_id": company_id,
+        "company": company,
+        "phone": phone,
+        "text": text,
+        "convo": convo,
+        "is_completed": is_completed,
+        "has_profile": has_profile,
+        "cep_padrao": (convo.get("cep_padrao") or "").strip(),
+    }
 
-        if not text:
-            reply = "Qual é o seu nome?"
-            log_message(company_id, phone, "out", reply)
-            return {"status": "ok", "reply": reply}
+    # step = "<nome>" ou "<prefixo>::<args>" -> handler pela chave, sem cadeia de ifs
+    key, sep, arg = step.partition("::")
+    handler = _STEP_HANDLERS.get(key + sep, _step_restart)
+    return handler(ctx, arg)
 
-        convo = update_conversation(company_id, phone, nome=text, step="email", status="open")
-        reply = f"Prazer, {convo.get('nome','')}! Qual é o seu e-mail?"
-        log_message(company_id, phone, "out", reply)
-        return {"status": "ok", "reply": reply}
 
-    # Step: EMAIL
-    if step == "email":
-        if not _is_valid_email(text):
-            reply = "Esse e-mail parece inválido 😅 Pode enviar novamente?"
-            log_message(company_id, phone, "out", reply)
-            return {"status": "ok", "reply": reply}
+def _reply(ctx: Dict[str, Any], reply: str) -> Dict[str, Any]:
+    log_message(ctx["company_id"], ctx["phone"], "out", reply)
+    return {"status": "ok", "reply": reply}
 
-        convo = update_conversation(company_id, phone, email=text, step="produto", status="open")
-        reply = "Perfeito! Qual serviço/produto você tem interesse?"
-        log_message(company_id, phone, "out", reply)
-        return {"status": "ok", "reply": reply}
 
-    # Step: PRODUTO
-    if step == "produto":
-        if not text or text.lower() in greetings:
-            if is_completed and has_profile:
-                reply = f"Olá, {convo.get('nome','')}! 😄 Qual serviço/produto você quer orçar agora?"
-            else:
-                reply = "Qual serviço/produto você tem interesse?"
-            log_message(company_id, phone, "out", reply)
-            return {"status": "ok", "reply": reply}
-
-        produto = text.strip()
-
-        if cep_padrao:
-            convo = update_conversation(company_id, phone, step=f"cep_confirm::{produto}", status="open")
-            reply = (
-                f"Show! Vou preparar o orçamento de *{produto}*.\n"
-                f"Quer usar o seu CEP padrão *{cep_padrao}*?\n"
-                "Responda:\n"
-                "1 = Sim (usar padrão)\n"
-                "2 = Não (informar outro CEP)"
-            )
-            log_message(company_id, phone, "out", reply)
-            return {"status": "ok", "reply": reply}
+def _update_step(ctx: Dict[str, Any], **fields) -> None:
+    ctx["convo"] = update_conversation(ctx["company_id"], ctx["phone"], **fields)
 
-        convo = update_conversation(company_id, phone, step=f"cep::{produto}", status="open")
-        reply = "Perfeito! Agora me envie seu CEP (apenas números) pra eu preparar a oferta certinha."
-        log_message(company_id, phone, "out", reply)
-        return {"status": "ok", "reply": reply}
-
-    # Step: CEP_CONFIRM
-    if step.startswith("cep_confirm::"):
-        produto = step.split("::", 1)[1].strip()
-
-        if text not in {"1", "2"}:
-            reply = "Me responde com 1 (usar CEP padrão) ou 2 (informar outro CEP)."
-            log_message(company_id, phone, "out", reply)
-            return {"status": "ok", "reply": reply}
-
-        if text == "1":
-            return await _finalize_quote(
-                company_id=company_id,
-                phone=phone,
-                company=company,
-                convo=convo,
-                produto=produto,
-                cep_usado=cep_padrao,
-                cep_alterado=False,
-                salvou_cep_padrao=False,
-                is_returning=is_completed and has_profile,
-                now_iso=now_iso,
-            )
 
-        convo = update_conversation(company_id, phone, step=f"cep::{produto}", status="open")
-        reply = "Beleza. Me envie o CEP (8 dígitos, só números)."
-        log_message(company_id, phone, "out", reply)
-        return {"status": "ok", "reply": reply}
-
-    # Step: CEP
-    if step.startswith("cep::"):
-        produto = step.split("::", 1)[1].strip()
-
-        cep_fmt = _normalize_cep(text)
-        if not cep_fmt:
-            reply = "CEP inválido. Envie apenas números (8 dígitos)."
-            log_message(company_id, phone, "out", reply)
-            return {"status": "ok", "reply": reply}
-
-        if cep_padrao and cep_fmt != cep_padrao:
-            convo = update_conversation(company_id, phone, step=f"cep_save::{produto}::{cep_fmt}", status="open")
-            reply = (
-                f"Entendi ✅ Vou usar o CEP *{cep_fmt}*.\n"
-                "Quer salvar esse CEP como seu novo CEP padrão?\n"
-                "1 = Sim\n"
-                "2 = Não"
-            )
-            log_message(company_id, phone, "out", reply)
-            return {"status": "ok", "reply": reply}
-
-        if not cep_padrao:
-            convo = update_conversation(company_id, phone, step=f"cep_save::{produto}::{cep_fmt}", status="open")
-            reply = (
-                f"Perfeito ✅ Vou usar o CEP *{cep_fmt}*.\n"
-                "Quer salvar esse CEP como padrão para próximos orçamentos?\n"
-                "1 = Sim\n"
-                "2 = Não"
-            )
-            log_message(company_id, phone, "out", reply)
-            return {"status": "ok", "reply": reply}
+def _finalize_from_ctx(
+    ctx: Dict[str, Any],
+    produto: str,
+    cep_usado: str,
+    cep_alterado: bool,
+    salvou_cep_padrao: bool,
+) -> Dict[str, Any]:
+    return _finalize_quote(
+        company_id=ctx["company_id"],
+        phone=ctx["phone"],
+        company=ctx["company"],
+        convo=ctx["convo"],
+        produto=produto,
+        cep_usado=cep_usado,
+        cep_alterado=cep_alterado,
+        salvou_cep_padrao=salvou_cep_padrao,
+        is_returning=ctx["is_completed"] and ctx["has_profile"],
+    )
 
-        return await _finalize_quote(
-            company_id=company_id,
-            phone=phone,
-            company=company,
-            convo=convo,
-            produto=produto,
-            cep_usado=cep_fmt,
-            cep_alterado=False,
-            salvou_cep_padrao=False,
-            is_returning=is_completed and has_profile,
-            now_iso=now_iso,
-        )
 
-    # Step: CEP_SAVE
-    if step.startswith("cep_save::"):
-        try:
-            rest = step.split("cep_save::", 1)[1]
-            produto, cep_fmt = rest.split("::", 1)
-            produto = produto.strip()
-            cep_fmt = cep_fmt.strip()
-        except Exception:
-            convo = update_conversation(company_id, phone, step="produto", status="open")
-            reply = "Vamos seguir 🙂 Qual serviço/produto você quer orçar?"
-            log_message(company_id, phone, "out", reply)
-            return {"status": "ok", "reply": reply}
+# Step: NOME
+def _step_nome(ctx: Dict[str, Any], arg: str) -> Dict[str, Any]:
+    text = ctx["text"]
+    if text.lower() in GREETINGS:
+        return _reply(ctx, "Olá! 👋 Tudo bem? Qual é o seu nome?")
 
-        if text not in {"1", "2"}:
-            reply = "Me responde com 1 (salvar como padrão) ou 2 (não salvar)."
-            log_message(company_id, phone, "out", reply)
-            return {"status": "ok", "reply": reply}
+    if not text:
+        return _reply(ctx, "Qual é o seu nome?")
 
-        salvou = (text == "1")
-        cep_alterado = bool(cep_padrao) and (cep_fmt != cep_padrao)
+    _update_step(ctx, nome=text, step="email", status="open")
+    return _reply(ctx, f"Prazer, {ctx['convo'].get('nome','')}! Qual é o seu e-mail?")
 
-        if salvou:
-            convo = update_conversation(company_id, phone, cep_padrao=cep_fmt, status="open")
-        else:
-            convo = update_conversation(company_id, phone, status="open")
 
-        return await _finalize_quote(
-            company_id=company_id,
-            phone=phone,
-            company=company,
-            convo=convo,
-            produto=produto,
-            cep_usado=cep_fmt,
-            cep_alterado=cep_alterado,
-            salvou_cep_padrao=salvou,
-            is_returning=is_completed and has_profile,
-            now_iso=now_iso,
-        )
+# Step: EMAIL
+def _step_email(ctx: Dict[str, Any], arg: str) -> Dict[str, Any]:
+    text = ctx["text"]
+    if not _is_valid_email(text):
+        return _reply(ctx, "Esse e-mail parece inválido 😅 Pode enviar novamente?")
 
-    convo = update_conversation(company_id, phone, step="nome", status="open")
-    reply = "Vamos recomeçar 🙂 Qual é o seu nome?"
-    log_message(company_id, phone, "out", reply)
-    return {"status": "ok", "reply": reply}
+    _update_step(ctx, email=text, step="produto", status="open")
+    return _reply(ctx, "Perfeito! Qual serviço/produto você tem interesse?")
 
 
-async def _finalize_quote(
+# Step: PRODUTO
+def _step_produto(ctx: Dict[str, Any], arg: str) -> Dict[str, Any]:
+    text = ctx["text"]
+    if not text or text.lower() in GREETINGS:
+        if ctx["is_completed"] and ctx["has_profile"]:
+            return _reply(ctx, f"Olá, {ctx['convo'].get('nome','')}! 😄 Qual serviço/produto você quer orçar agora?")
+        return _reply(ctx, "Qual serviço/produto você tem interesse?")
+
+    produto = text
+    cep_padrao = ctx["cep_padrao"]
+
+    if cep_padrao:
+        _update_step(ctx, step=f"cep_confirm::{produto}", status="open")
+        return _reply(ctx, _CEP_CONFIRM_TMPL.format(produto=produto, cep_padrao=cep_padrao))
+
+    _update_step(ctx, step=f"cep::{produto}", status="open")
+    return _reply(ctx, "Perfeito! Agora me envie seu CEP (apenas números) pra eu preparar a oferta certinha.")
+
+
+# Step: CEP_CONFIRM
+def _step_cep_confirm(ctx: Dict[str, Any], arg: str) -> Dict[str, Any]:
+    produto = arg.strip()
+    text = ctx["text"]
+
+    if text not in {"1", "2"}:
+        return _reply(ctx, "Me responde com 1 (usar CEP padrão) ou 2 (informar outro CEP).")
+
+    if text == "1":
+        return _finalize_from_ctx(ctx, produto, ctx["cep_padrao"], cep_alterado=False, salvou_cep_padrao=False)
+
+    _update_step(ctx, step=f"cep::{produto}", status="open")
+    return _reply(ctx, "Beleza. Me envie o CEP (8 dígitos, só números).")
+
+
+# Step: CEP
+def _step_cep(ctx: Dict[str, Any], arg: str) -> Dict[str, Any]:
+    produto = arg.strip()
+    cep_padrao = ctx["cep_padrao"]
+
+    cep_fmt = _normalize_cep(ctx["text"])
+    if not cep_fmt:
+        return _reply(ctx, "CEP inválido. Envie apenas números (8 dígitos).")
+
+    if cep_padrao and cep_fmt != cep_padrao:
+        _update_step(ctx, step=f"cep_save::{produto}::{cep_fmt}", status="open")
+        return _reply(ctx, _CEP_SAVE_NOVO_TMPL.format(cep=cep_fmt))
+
+    if not cep_padrao:
+        _update_step(ctx, step=f"cep_save::{produto}::{cep_fmt}", status="open")
+        return _reply(ctx, _CEP_SAVE_PRIMEIRO_TMPL.format(cep=cep_fmt))
+
+    return _finalize_from_ctx(ctx, produto, cep_fmt, cep_alterado=False, salvou_cep_padrao=False)
+
+
+# Step: CEP_SAVE
+def _step_cep_save(ctx: Dict[str, Any], arg: str) -> Dict[str, Any]:
+    produto, sep, cep_fmt = arg.partition("::")
+    produto = produto.strip()
+    cep_fmt = cep_fmt.strip()
+    if not sep:
+        _update_step(ctx, step="produto", status="open")
+        return _reply(ctx, "Vamos seguir 🙂 Qual serviço/produto você quer orçar?")
+
+    text = ctx["text"]
+    if text not in {"1", "2"}:
+        return _reply(ctx, "Me responde com 1 (salvar como padrão) ou 2 (não salvar).")
+
+    cep_padrao = ctx["cep_padrao"]
+    salvou = (text == "1")
+    cep_alterado = bool(cep_padrao) and (cep_fmt != cep_padrao)
+
+    if salvou:
+        _update_step(ctx, cep_padrao=cep_fmt, status="open")
+    else:
+        _update_step(ctx, status="open")
+
+    return _finalize_from_ctx(ctx, produto, cep_fmt, cep_alterado=cep_alterado, salvou_cep_padrao=salvou)
+
+
+def _step_restart(ctx: Dict[str, Any], arg: str) -> Dict[str, Any]:
+    _update_step(ctx, step="nome", status="open")
+    return _reply(ctx, "Vamos recomeçar 🙂 Qual é o seu nome?")
+
+
+_STEP_HANDLERS = {
+    "nome": _step_nome,
+    "email": _step_email,
+    "produto": _step_produto,
+    "cep_confirm::": _step_cep_confirm,
+    "cep::": _step_cep,
+    "cep_save::": _step_cep_save,
+}
+
+
+def _finalize_quote(
     company_id: str,
     phone: str,
     company: Dict[str, Any],
@@ -770,49 +1401,48 @@ async def _finalize_quote(
     cep_alterado: bool,
     salvou_cep_padrao: bool,
     is_returning: bool,
-    now_iso: str,
 ):
     """
     Blindado:
-    1) Insere quote no DB (se falhar, não exporta)
-    2) Exporta pro Sheets (se falhar, não trava o fluxo)
-    3) Marca convo como completed e step=produto (pronto pra novo orçamento)
+    1) DB numa transação só: quote + convo completed/step=produto + log da resposta (se falhar, não exporta)
+    2) Enfileira o export pro Sheets (feito em lote em background; não trava o fluxo)
     """
-    quote_number = get_next_quote_number(company_id, phone)
+    # O update só mexe em step/status, então o nome pra resposta final já está na convo atual.
+    reply = _FINAL_TMPL.format(nome=convo.get("nome", ""), produto=produto, cep=cep_usado)
 
     # 1) DB primeiro (trava exportação se DB falhar)
     try:
-        qrow = insert_quote(
+        qrow = save_quote_and_complete(
             company_id=company_id,
             phone=phone,
-            quote_number=quote_number,
             produto=produto,
             cep_usado=cep_usado,
             cep_alterado=cep_alterado,
             salvou_cep_padrao=salvou_cep_padrao,
             is_returning=is_returning,
-            status="ok",
+            reply=reply,
         )
-    except Exception as e:
-        logger.exception(f"Falha ao salvar quote no DB: {e}")
+    except psycopg.Error as e:
+        logger.exception("Falha ao salvar quote no DB: %s", e)
         reply = "Tive um probleminha pra registrar seu pedido 😥 Pode me mandar de novo o produto/serviço?"
         log_message(company_id, phone, "out", reply)
         return {"status": "error", "reply": reply}
 
-    # 2) Sheets depois (não pode quebrar o atendimento)
+    # 2) Sheets depois (não pode quebrar o atendimento): só enfileira, a thread de export faz o append
     export_info = None
     export_error = None
     try:
-        sheet_id = (company.get("sheet_id") or DEFAULT_SHEET_ID or "").strip()
-        sheet_tab = (company.get("sheet_tab") or DEFAULT_SHEET_TAB or "Página1").strip()
+        sheet_id = (company.get("sheet_id") or DEFAULT_SHEET_ID).strip() if SHEETS_EXPORT_ENABLED else ""
 
-        if sheet_id and GOOGLE_SA_B64:
+        if sheet_id:
+            sheet_tab = (company.get("sheet_tab") or DEFAULT_SHEET_TAB).strip()
+            now_iso = datetime.now(timezone.utc).isoformat(timespec="seconds")  # só quando vai exportar
             row = [
                 now_iso,                              # created_at
                 company_id,                           # company_id
                 phone,                                # phone
                 1 if is_returning else 0,             # is_returning
-                int(quote_number),                    # quote_number
+                int(qrow["quote_number"]),            # quote_number
                 (convo.get("nome") or "").strip(),    # nome
                 (convo.get("email") or "").strip(),   # email
                 (produto or "").strip(),              # produto
@@ -822,21 +1452,15 @@ async def _finalize_quote(
                 1 if salvou_cep_padrao else 0,        # salvou_cep_padrao
                 "ok",                                 # status
             ]
-            export_info = append_to_sheets(sheet_id, sheet_tab, row)
-    except Exception as e:
+            enqueue_export(sheet_id, sheet_tab, row)
+            export_info = {"queued": True}
+    except queue.Full:
+        export_error = "fila de export cheia"
+        logger.error("Fila de export pro Sheets cheia; linha descartada (não bloqueia).")
+    except (AttributeError, TypeError, ValueError) as e:
+        # dado fora do formato esperado (company/convo/quote_number): não pode quebrar o atendimento
         export_error = str(e)
-        logger.error(f"Falha no export pro Sheets (não bloqueia): {e}")
-
-    # 3) Marca como completed e pronto pra novo orçamento
-    convo2 = update_conversation(company_id, phone, step="produto", status="completed")
-
-    reply = (
-        f"Fechado, {convo2.get('nome','')} ✅\n"
-        f"Já registrei seu interesse em *{produto}*.\n"
-        f"CEP considerado: *{cep_usado}*.\n\n"
-        "Um vendedor vai te chamar em breve com uma oferta preparada pra você. 🤝"
-    )
-    log_message(company_id, phone, "out", reply)
+        logger.error("Falha ao enfileirar export pro Sheets (não bloqueia): %s", e)
 
     payload = {"status": "ok", "reply": reply, "quote": qrow, "export": export_info}
     if export_error:
@@ -0,0 +1,16 @@
+import multiprocessing
+import os
+
+# Produção (Render):  gunicorn -c gunicorn_conf.py app:app
+# Cada worker é um processo com seu próprio event loop (Uvicorn), então webhooks concorrentes
+# rodam em paralelo entre workers, e dentro de cada um pelo pool de threads do fluxo.
+
+bind = f"0.0.0.0:{os.getenv('PORT', '10000')}"
+# UvicornWorker (pacote uvicorn-worker) usa loop/http "auto": com uvicorn[standard] isso é uvloop + httptools.
+worker_class = "uvicorn_worker.UvicornWorker"
+# Worker async não segue a regra 2*CPU+1 dos workers sync, e cada um abre até DB_POOL_MAX conexões
+# no Postgres. cpu_count() vê os cores do host, não o limite do container, então o padrão tem teto.
+workers = int(os.getenv("WEB_CONCURRENCY", min(multiprocessing.cpu_count(), 4)))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "30"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "30"))
+graceful_timeout = timeout